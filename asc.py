@@ -2,11 +2,11 @@
 Transform asc files into ply or stl.
 """
 
-from numpy import sqrt, arcsin, arctan2, floor, pi
+from numpy import sqrt, arcsin, arctan2, floor, pi, dtype, array
 from collections import namedtuple
 
 Patch = namedtuple('Patch', ['points', 'faces'])
-Point = namedtuple('Point', ['pid', 'x', 'y', 'z'])
+Point = dtype([('pid', '<i4'), ('xyz', '<f8', 3)])  # point id and coordinates
 
 
 def get_points_raw(fname):
@@ -20,6 +20,7 @@ def get_points_raw(fname):
 
 def get_points(points_raw, row_length=0):
     "Return points (list of rows) from a list of raw points"
+    # Each row is a numpy array of Point, as in the projections module.
     fast_angle = find_fast_angle(points_raw)
 
     points = []
@@ -36,24 +37,24 @@ def get_points(points_raw, row_length=0):
             pass
         elif row_length > 0:
             if pid % row_length == 0:
-                points.append(row)
+                points.append(array(row, dtype=Point))
                 row = []
         else:
             d_theta = mod(theta - theta_last, 2 * pi)
             d_phi = mod(phi - phi_last, pi)
             if fast_angle == 'theta':
                 if abs(d_phi) > delta_threshold:
-                    points.append(row)
+                    points.append(array(row, dtype=Point))
                     row = []
             elif fast_angle == 'phi':
                 if abs(d_theta) > delta_threshold:
-                    points.append(row)
+                    points.append(array(row, dtype=Point))
                     row = []
 
-        row.append(Point(pid, x, y, z))
+        row.append((pid, (x, y, z)))
         theta_last, phi_last = theta, phi
         pid += 1
-    points.append(row)  # don't forget to append the last row!
+    points.append(array(row, dtype=Point))  # don't forget the last row!
     return points
 
 
@@ -8,45 +8,97 @@ related to what I want to do in the main program.
 """
 
 import os
+import sys
+import io
+import shlex
+import runpy
+import shutil
+import subprocess
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 from tempfile import NamedTemporaryFile
-from contextlib import contextmanager
+from contextlib import contextmanager, redirect_stdout, redirect_stderr
 from PIL import Image
 import numpy as np
 
 
-def run(cmd):
-    print('\x1b[35m%s\x1b[0m' % cmd)
-    os.system(cmd)
+def run(*cmds):
+    "Run the given shell commands, all at the same time if there are several"
+    if len(cmds) == 1:
+        print('\x1b[35m%s\x1b[0m' % cmds[0])
+        os.system(cmds[0])
+    else:
+        with ProcessPoolExecutor(os.cpu_count()) as executor:
+            for cmd, output in zip(cmds, executor.map(get_output, cmds)):
+                print('\x1b[35m%s\x1b[0m' % cmd)
+                print(output, end='')
+
+
+def get_output(cmd):
+    "Return the output of shell command cmd (run with no input)"
+    if cmd.startswith('../mapelia '):
+        return get_mapelia_output(shlex.split(cmd)[1:])
+    return subprocess.run(cmd, shell=True, stdin=subprocess.DEVNULL,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                          text=True).stdout
+
+
+_mapelia_main = None  # main() of mapelia, loaded once per worker process
+
+def get_mapelia_output(argv):
+    "Return the output of running mapelia with argv, in this same process"
+    # This saves starting python and importing maps, numpy, PIL... for each
+    # command, which takes most of the time with the small example maps.
+    global _mapelia_main
+    if _mapelia_main is None:
+        sys.path.append('..')
+        _mapelia_main = runpy.run_path('../mapelia')['main']
+
+    output = io.StringIO()
+    with redirect_stdout(output), redirect_stderr(output):
+        stdin, sys.stdin = sys.stdin, io.StringIO()  # no answers to questions
+        try:
+            _mapelia_main(argv)
+        except SystemExit as e:
+            if e.code not in [None, 0]:
+                print(e.code)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            sys.stdin = stdin
+    return output.getvalue()
 
 
 def test_mapelia():
-    run('../mapelia venus.png')
-    run('../mapelia earth_equirectangular.jpg '
-        '--projection equirectangular --channel hue '
-        '--meridians-pos --meridians-widths')
-    run('../mapelia earth_tissot_mollweide.jpg '
-        '--projection mollweide --channel average '
-        '--caps none --meridians-pos --meridians-widths --invert')
-    run('../mapelia earth_tissot_equirectangular.jpg '
-        '--projection equirectangular --logo-south logo_observatori.png '
-        '--caps 10 --meridians-pos --meridians-widths')
-    run('../mapelia earth_central-cylindrical.jpg '
-        '--projection central-cylindrical --caps 30 --meridians-pos 90 '
-        '--scale 0.05 --caps-height 1.2 --meridians-height 1.1 --type stl')
-    run('../mapelia venus.png --thickness 0.2 --type stl '
-        '--meridians-pos --meridians-widths')
-    run('../mapelia venus.png --output venus_with_logos.ply '
-        '--logo-north logo_observatori.png --logo-north-scale -0.5 '
-        '--logo-south logo_observatori.png --logo-south-scale 2')
-    run('../mapelia venus.png --output venus_many_meridians.ply '
-        '--meridians-pos -10 90 170 --meridians-widths 2 5 8')
-    run('../mapelia venus.png --output venus_equator.ply '
-        '--equator-width 2 --equator-height 1.04')
-    run('../mapelia wmap.jpg --projection mollweide --output wmap_blurred.ply '
-        '--meridians-pos --meridians-widths --scale 0.04 --blur 2')
-    run('../mapelia venus.png --scale 0.06 --output venus_blurred.ply --blur 1')
     with temp_config_file() as f:
-        run('../mapelia --config %s venus.png' % f.name)
+        run('../mapelia venus.png',
+            '../mapelia earth_equirectangular.jpg '
+            '--projection equirectangular --channel hue '
+            '--meridians-pos --meridians-widths',
+            '../mapelia earth_tissot_mollweide.jpg '
+            '--projection mollweide --channel average '
+            '--caps none --meridians-pos --meridians-widths --invert',
+            '../mapelia earth_tissot_equirectangular.jpg '
+            '--projection equirectangular --logo-south logo_observatori.png '
+            '--caps 10 --meridians-pos --meridians-widths',
+            '../mapelia earth_central-cylindrical.jpg '
+            '--projection central-cylindrical --caps 30 --meridians-pos 90 '
+            '--scale 0.05 --caps-height 1.2 --meridians-height 1.1 --type stl',
+            '../mapelia venus.png --thickness 0.2 --type stl '
+            '--meridians-pos --meridians-widths',
+            '../mapelia venus.png --output venus_with_logos.ply '
+            '--logo-north logo_observatori.png --logo-north-scale -0.5 '
+            '--logo-south logo_observatori.png --logo-south-scale 2',
+            '../mapelia venus.png --output venus_many_meridians.ply '
+            '--meridians-pos -10 90 170 --meridians-widths 2 5 8',
+            '../mapelia venus.png --output venus_equator.ply '
+            '--equator-width 2 --equator-height 1.04',
+            '../mapelia wmap.jpg --projection mollweide '
+            '--output wmap_blurred.ply '
+            '--meridians-pos --meridians-widths --scale 0.04 --blur 2',
+            '../mapelia venus.png --scale 0.06 --output venus_blurred.ply '
+            '--blur 1',
+            '../mapelia --config %s venus.png' % f.name)
 
 
 @contextmanager
@@ -72,24 +124,24 @@ output: venus_from_config_file.stl
 
 
 def test_pintelia():
-    run('../pintelia earth_mercator.png')
-    run('../pintelia wmap.jpg --projection mollweide')
+    run('../pintelia earth_mercator.png',
+        '../pintelia wmap.jpg --projection mollweide')
 
 
 def test_poligoniza():
-    run('../mapelia moon.jpg --type asc')
-    run('../poligoniza moon.asc')
-    run('../poligoniza moon.asc --type stl')
+    run('../mapelia moon.jpg --type asc')  # needed by the ones below
+    run('../poligoniza moon.asc',
+        '../poligoniza moon.asc --type stl')
 
 
 def test_stl_split():
     run('../mapelia wmap.jpg --projection mollweide --channel hue '
         '--scale 0.10 --caps 8 --thickness 0.2 --type stl')
-    run('../stl-split wmap.stl')
-    run('../stl-split --number 10000 wmap.stl')
-    run('../stl-split --zcut 0.7 --name wmap_uneven wmap.stl')
-    run('../stl-split --zcut auto --name wmap_auto wmap.stl')
-    run('../stl-split --zcut auto --discard-border '
+    run('../stl-split wmap.stl',
+        '../stl-split --number 10000 wmap.stl',
+        '../stl-split --zcut 0.7 --name wmap_uneven wmap.stl',
+        '../stl-split --zcut auto --name wmap_auto wmap.stl',
+        '../stl-split --zcut auto --discard-border '
         '--name wmap_auto_border wmap.stl')
 
 
@@ -107,7 +159,6 @@ def test_smooth():
 
 def show_colored_rows():
     import os
-    import sys
     sys.path.append('..')
     import asc
     os.system('../mapelia earth_equirectangular.jpg --type asc '
@@ -135,19 +186,21 @@ end_header\n""" % len(points_raw))
         for row in points:
             color = (r(), r(), r())
             for p in row:
-                _, x, y, z = map(float, p)
+                x, y, z = map(float, p['xyz'])
                 fout.write('%g %g %g %d %d %d\n' % (x, y, z, *color))
     os.system('meshlab test.ply')
 
 
 def write_ply():
+    sys.path.append('..')
+    import formats
     points = sphere_rows()
     #points = plane_rows()
 
-    nvertex = points[-1][-1][0] + 1  # sum(map(len, points))
-    faces = list(get_faces(points))
-    with open('sphere.ply', 'wt') as fout:
-        fout.write("""\
+    vertices = np.vstack(points)  # rows of n, x, y, z
+    faces = get_faces(points)
+    with open('sphere.ply', 'wb') as fout:
+        fout.write(b"""\
 ply
 format ascii 1.0
 element vertex %d
@@ -157,101 +210,111 @@ property float z
 element face %d
 property list uint8 int32 vertex_index
 end_header
-""" % (nvertex, len(faces)))
-        for row in points:
-            for p, x, y, z in row:
-                fout.write('%g %g %g\n' % (x, y, z))
-        for f in faces:
-            fout.write('3 %d %d %d\n' % f)
+""" % (len(vertices), len(faces)))
+        formats.write_text(fout, vertices[:,1:], '%g %g %g')
+        formats.write_text(fout, faces, '3 %d %d %d')
 
 
 def get_faces(points):
-    "Yield faces as triplets of point indices"
+    "Return array (n x 3) with the faces as triplets of point indices"
     # points must be a list of rows, each containing the actual points
-    # that correspond to a (closed!) section of an object.
-    def dist2(p0, p1):
-        _, x0, y0, z0 = p0
-        _, x1, y1, z1 = p1
+    # that correspond to a (closed!) section of an object. The index of a
+    # point is its position in all the rows together: row_off[j] + i.
+    coords = np.concatenate(points)[:,1:].tolist()  # x, y, z of all points
+    row_off = np.cumsum([0] + [len(row) for row in points]).tolist()
+    faces = np.empty((2 * row_off[-1], 3), dtype=int)  # grown if needed
+    nfaces = 0
+
+    def add(face):
+        nonlocal faces, nfaces
+        if nfaces == len(faces):
+            faces = np.concatenate([faces, np.empty_like(faces)])
+        faces[nfaces] = face
+        nfaces += 1
+
+    def dist2(k0, k1):
+        x0, y0, z0 = coords[k0]
+        x1, y1, z1 = coords[k1]
         return (x1 - x0)**2 + (y1 - y0)**2 + (z1 - z0)**2
 
     # h
     # b l
     for j in range(1, len(points)):
-        row_current = points[j]
-        row_previous = points[j - 1]
+        current, previous = row_off[j], row_off[j - 1]  # where rows start
+        n_current, n_previous = len(points[j]), len(points[j - 1])
         hoagie = 0
-        for i in range(len(row_current)):
-            bernard = i
-            laverne = (i + 1) % len(row_current)
-            hoagie_start = hoagie
+        for i in range(n_current):
+            bernard = current + i
+            laverne = bernard + 1 if i + 1 < n_current else current
             hoagie_walking = hoagie
-            dbh = dist2(row_current[bernard], row_previous[hoagie_walking])
+            dbh = dist2(bernard, previous + hoagie_walking)
             while True:
-                hoagie_walking = (hoagie_walking + 1) % len(row_previous)
-                d = dist2(row_current[bernard], row_previous[hoagie_walking])
+                hoagie_walking += 1
+                if hoagie_walking == n_previous:  # wrap around the row
+                    hoagie_walking = 0
+                d = dist2(bernard, previous + hoagie_walking)
                 if d < dbh:
-                    yield (row_current[bernard][0], row_previous[hoagie][0], row_previous[hoagie_walking][0])
+                    add((bernard, previous + hoagie,
+                         previous + hoagie_walking))
                     hoagie = hoagie_walking
                     dbh = d
                 else:
                     break
-            yield (row_current[bernard][0], row_previous[hoagie][0], row_current[laverne][0])
-        yield (row_current[0][0], row_previous[hoagie][0], row_previous[0][0])
+            add((bernard, previous + hoagie, laverne))
+        add((current, previous + hoagie, previous))
+
+    return faces[:nfaces]
 
 
 def plane_rows():
-    points = []
-    n = 0
-    for y in np.arange(2, -2, -0.5):
-        row = []
-        for x in np.arange(-2, 2, 0.5):
-            row.append((n, x, y, 0))
-            n += 1
-        points.append(row)
-    return points
+    xs, ys = np.meshgrid(np.arange(-2, 2, 0.5), np.arange(2, -2, -0.5))
+    ns = np.arange(xs.size).reshape(xs.shape)
+    return [np.column_stack([n, x, y, np.zeros(len(x))])
+            for n, x, y in zip(ns, xs, ys)]
 
 
 def sphere_rows():
     points = []
     n = 0
-    for phi in np.arange(-np.pi/2, np.pi/2, 0.01):
-        row = []
-        #for theta in np.arange(-np.pi, np.pi, 0.1):
-        for theta in np.linspace(-np.pi, np.pi, max(5, int(200 * np.cos(phi)))):
-            x = np.cos(theta) * np.cos(phi)
-            y = np.sin(theta) * np.cos(phi)
-            z = np.sin(phi)
-            row.append((n, x, y, z))
-            n += 1
+    phis = np.arange(-np.pi/2, np.pi/2, 0.01)
+    cos_phis, sin_phis = np.cos(phis), np.sin(phis)
+    nthetas = np.maximum(5, (200 * cos_phis).astype(int))
+    for cos_phi, sin_phi, ntheta in zip(cos_phis, sin_phis, nthetas):
+        #theta = np.arange(-np.pi, np.pi, 0.1)
+        theta = np.linspace(-np.pi, np.pi, ntheta)
+        row = np.column_stack([np.arange(n, n + ntheta),
+                               np.cos(theta) * cos_phi,
+                               np.sin(theta) * cos_phi,
+                               np.full(ntheta, sin_phi)])
+        n += ntheta
         points.append(row)
     return points
 
 
 def sphere():
-    for phi in np.arange(-np.pi/2, np.pi/2, 0.2):
-        for theta in np.arange(-np.pi, np.pi, 0.2):
-            x = np.cos(theta) * np.cos(phi)
-            y = np.sin(theta) * np.cos(phi)
-            z = np.sin(phi)
-            yield (x, y, z)
+    "Return array (n x 3) with the x, y, z of points on a sphere"
+    thetas, phis = np.meshgrid(np.arange(-np.pi, np.pi, 0.2),
+                               np.arange(-np.pi/2, np.pi/2, 0.2))
+    return np.column_stack([(np.cos(thetas) * np.cos(phis)).ravel(),
+                            (np.sin(thetas) * np.cos(phis)).ravel(),
+                            np.sin(phis).ravel()])
 
 
 def write_sphere_asc():
     "Write file sphere.asc with points of a sphere"
-    with open('sphere.asc', 'wt') as fout:
-        for xyz in sphere():
-            fout.write('%g %g %g\n' % xyz)
+    sys.path.append('..')
+    import formats
+    with open('sphere.asc', 'wb') as fout:
+        formats.write_text(fout, sphere(), '%g %g %g')
 
 
 def create_hue_image():
     "Return an image with hue lines"
     nx, ny = (1024, 720)
-    img = Image.new('HSV', (nx, ny))
-    for i in range(nx):
-        hue = min(i // 4, 256)
-        for j in range(ny):
-            img.putpixel((i, j), (hue, 250, 200))
-    return img.convert('RGB')
+    hues = np.minimum(np.arange(nx) // 4, 255)
+    row = np.column_stack([hues, np.full(nx, 250), np.full(nx, 200)])
+    hsv = np.tile(row.astype(np.uint8), (ny, 1, 1))  # the same in all rows
+    return Image.fromarray(hsv, 'HSV').convert('RGB')
 
 
 def get_rgb_values(img):
@@ -272,29 +335,27 @@ def get_rgb_values(img):
 def palette_test():
     "Return an image with lines of the palette from palette.tab"
     nx, ny = (1024, 720)
-    img = Image.new('HSV', (nx, ny))
     palette_file = ('pds-geosciences.wustl.edu/mgn/mgn-v-gxdr-v1/mg_3002/gsdr/'
                     'merc/palette.tab')
     get_rgb = lambda line: tuple(map(int, line.split()[1:]))
-    rgbs = [get_rgb(line) for line in open(palette_file)]
-    for i in range(nx):
-        level = min(i // 4, 255)
-        for j in range(ny):
-            img.putpixel((i, j), rgbs[level])
-    return img
+    rgbs = np.array([get_rgb(line) for line in open(palette_file)],
+                    dtype=np.uint8)
+    levels = np.minimum(np.arange(nx) // 4, 255)
+    return Image.fromarray(np.tile(rgbs[levels], (ny, 1, 1)), 'HSV')
 
 
 def print_palette_hsv():
     "Print hue,saturation,value for the colors specified in palette.tab"
     from urllib.request import urlopen
-    from colorsys import rgb_to_hsv
+    sys.path.append('..')
+    from maps import rgb_to_hsv  # like colorsys', but for numpy arrays
     palette_url = ('http://pds-geosciences.wustl.edu/mgn/mgn-v-gxdr-v1/'
                    'mg_3002/gsdr/merc/palette.tab')
     rgbs = [tuple(map(int, line.split()[1:])) for line in urlopen(palette_url)]
 
     # Smart way.
-    hsvs_smart = [rgb_to_hsv(r / 255, g / 255, b / 255) for r, g, b in rgbs]
-    print([(int(h * 255), int(s * 255), int(v * 255)) for h, s, v in hsvs_smart])
+    hsvs_smart = np.column_stack(rgb_to_hsv(*np.array(rgbs).T / 255))
+    print([tuple(hsv) for hsv in (hsvs_smart * 255).astype(int).tolist()])
 
     # Stupid way.
     imgRGB = Image.new('RGB', (1, 256))
@@ -310,45 +371,30 @@ def print_palette_hsv():
 
 def rgb2gray(img):
     "Return image whose grayscale values correspond to the average rgb in img"
-    values = np.average(img, axis=2)
-    return Image.fromarray(values).convert('RGB')
+    # Not img.convert('L'), which weights the channels instead of averaging.
+    return Image.fromarray(get_values(img).T, 'L').convert('RGB')
 
 
 def rgb2gray_slow(img):
     "Return image whose grayscale values correspond to the red-to-blue in img"
     values = get_values(img)  # TODO: should we normalize?
-    imgL = img.convert('L')
-    nx, ny = img.size
-    for i in range(nx):
-        for j in range(ny):
-            imgL.putpixel((i, j), (values[i, j],))
-    return imgL
-    # I wrote this version before knowing you could do it so nicely
-    # and fast in a different way...
+    return Image.fromarray(values.T, 'L')
+    # I first wrote this version putting pixel by pixel, before knowing you
+    # could do it so nicely and fast with numpy...
 
 
 def get_values(img):
     "Return array with the red-to-blue values of the given image"
-    values = np.zeros(img.size, dtype=np.int8)
-    nx, ny = img.size
-    for i in range(nx):
-        for j in range(ny):
-            r, g, b = img.getpixel((i, j))
-            values[i, j] = (r + g + b) / 3
-    return values
+    r, g, b = [np.asarray(band, dtype=np.uint16)
+               for band in img.convert('RGB').split()]
+    return ((r + g + b) // 3).astype(np.uint8).T  # indexed as [i, j]
     # This is intended to undo the heigth->color transformation from the
     # original map, but, what is actually the original transformation?
 
 
 def hue2gray(img):
     "Return an image whose grayscale values correspond to the hues in img"
-    hues = get_hues(img)
-    imgL = img.convert('L')
-    nx, ny = img.size
-    for i in range(nx):
-        for j in range(ny):
-            imgL.putpixel((i, j), (hues[i, j],))
-    return imgL
+    return img.convert('HSV').getchannel('H')  # already an L image
 
 
 def get_hues(img):
@@ -358,49 +404,44 @@ def get_hues(img):
 
 def get_hues_slow(img):
     "Return array with the hue values of the given image"
-    hues = np.zeros(img.size, dtype=np.int)
-    imgHSV = img.convert('HSV')
-    nx, ny = img.size
-    for i in range(nx):
-        for j in range(ny):
-            hues[i, j] = imgHSV.getpixel((i, j))[0]
-    return hues
-    # I wrote this version before knowing you could do it so nicely
-    # and fast in a different way...
+    return get_hues(img).T.astype(int)  # indexed as [i, j]
+    # I first wrote this version reading pixel by pixel, before knowing you
+    # could do it so nicely and fast with numpy...
 
 
-def modify_ply():
-    with open(fname) as fin:
+def modify_ply(fname, nvertices, nfaces):
+    with open(fname, 'rb') as fin:
         with open(fname + '_with_caps', 'wb') as fout:
             while True:
                 line = fin.readline()
-                if line.startswith('element vertex'):
+                if line.startswith(b'element vertex'):
                     n = int(line.split()[-1])
-                    fout.write('element vertex %d', n + nvertices)
-                elif line.startswith('element face'):
+                    fout.write(b'element vertex %d\n' % (n + nvertices))
+                elif line.startswith(b'element face'):
                     n = int(line.split()[-1])
-                    fout.write('element face %d', n + nfaces)
-                elif line.startswith('end_header'):
+                    fout.write(b'element face %d\n' % (n + nfaces))
+                elif line.startswith(b'end_header'):
                     fout.write(line)
                     break
                 else:
                     fout.write(line)
-            fout.write(fin.read())
+            shutil.copyfileobj(fin, fout, 2**20)  # in chunks, not all at once
             # not really, we have to add the new vertices first, then the new
             # faces.
 
 
 def find_border(triangles, zcut):
     "Return the points that form part of at most 2 triangles"
-    appearances = {}
-    for triangle in triangles:
-        for i in range(3):
-            start = 12 + i * 12
-            p = struct.unpack('<3f', triangle[start:start+12])
-            appearances.setdefault(p, 0)
-            appearances[p] += 1
-    return sorted((p for p, n in appearances.items() if n < 5 and abs(p[2] - zcut) < 10),
-                  key=lambda p: math.atan2(p[1], p[0]))
+    stl_triangle = np.dtype([('normal', '<f4', 3),
+                             ('vertices', '<f4', (3, 3)),
+                             ('attribute', '<u2')])
+    data = np.frombuffer(b''.join(triangles), dtype=stl_triangle)
+    points, appearances = np.unique(data['vertices'].reshape(-1, 3), axis=0,
+                                    return_counts=True)
+    border = points[(appearances < 5) & (abs(points[:,2] - zcut) < 10)]
+    border = border.astype(float)  # angles as precise as with math.atan2()
+    order = np.argsort(np.arctan2(border[:,1], border[:,0]), kind='stable')
+    return [tuple(p) for p in border[order].tolist()]
 
 
 def add_border(triangles, zcut):
@@ -4,10 +4,12 @@ Functions to create 3D files in the following formats: ply, asc, stl.
 
 import struct
 
+import numpy as np
+
 
 def write_ply(fname, patches):
     "Create ply file fname with the points and faces in patches"
-    nvertices = patches[-1].points[-1][-1].pid + 1 if patches else 0
+    nvertices = patches[-1].points[-1]['pid'][-1] + 1 if patches else 0
     all_points, all_faces = zip(*patches)
 
     with open(fname, 'wb') as fout:
@@ -36,31 +38,48 @@ end_header
 
 
 def write_vertices(fout, points, binary=True):
-    "Write in fout the tuples of x, y, z that define the vertices"
+    "Write in fout the x, y, z coordinates that define the vertices"
     if binary:
-        write = lambda x, y, z: fout.write(struct.pack(b'<3f', x, y, z))
+        get_coords(points, dtype='<f4').tofile(fout)
     else:
-        write = lambda x, y, z: fout.write(b'%g %g %g\n' % (x, y, z))
-
-    for row in points:
-        for p, x, y, z in row:
-            write(x, y, z)
+        write_text(fout, get_coords(points), '%g %g %g')
 
 
 def write_faces(fout, faces, binary=True, invert=False):
     "Write in fout the lists of indices that define the faces"
-    if not invert:
-        reorder = lambda f: f
-    else:
-        reorder = lambda f: (f[0], f[2], f[1])
+    faces = get_indices(faces, invert)
 
     if binary:
-        write = lambda f: fout.write(struct.pack(b'<B3i', 3, *reorder(f)))
+        # Each face is a record like: uchar 3, int p0, int p1, int p2
+        records = np.empty(len(faces), dtype=[('n', 'u1'), ('v', '<i4', 3)])
+        records['n'] = 3
+        records['v'] = faces
+        records.tofile(fout)
     else:
-        write = lambda f: fout.write(b'3 %d %d %d\n' % reorder(f))
+        write_text(fout, faces, '3 %d %d %d')
+
+
+def write_text(fout, rows, fmt, block_size=2**16):
+    "Write in fout the rows of the array formatted with fmt, one per line"
+    # Much faster than np.savetxt(), which formats and writes line by line.
+    lines = fmt + '\n'
+    for i in range(0, len(rows), block_size):
+        block = rows[i:i+block_size]
+        text = (lines * len(block)) % tuple(block.ravel().tolist())
+        fout.write(text.encode())
 
-    for f in faces:
-        write(f)
+
+def get_coords(points, dtype=float):
+    "Return array (n x 3) with the x, y, z of the points (a list of rows)"
+    if len(points) == 0:
+        return np.empty((0, 3), dtype=dtype)
+    return np.concatenate(points)['xyz'].astype(dtype)
+
+
+def get_indices(faces, invert=False):
+    "Return array (n x 3) with the indices of the points that form the faces"
+    indices = np.asarray(faces, dtype='<i4').reshape(-1, 3)
+    return indices if not invert else indices[:, (0, 2, 1)]
 
 
 def write_asc(fname, patches):
@@ -73,21 +92,17 @@ def write_asc(fname, patches):
 def write_stl(fname, patches, invert=False):
     "Create stl file fname with the triangles in patches"
     all_points, all_faces = zip(*patches)
-    points_flat = [(p.x, p.y, p.z) for points in all_points
-                                   for row in points for p in row]
+    coords = np.concatenate([get_coords(points, dtype='<f4')
+                             for points in all_points])
+    faces = np.concatenate([get_indices(faces, invert)
+                            for faces in all_faces])
 
-    order = (0, 1, 2) if not invert else (0, 2, 1)
+    triangles = np.zeros(len(faces), dtype=[('normal', '<f4', 3),  # (empty)
+                                            ('vertices', '<f4', (3, 3)),
+                                            ('attribute', '<u2')])  # (empty)
+    triangles['vertices'] = coords[faces]
 
     with open(fname, 'wb') as fout:
-        write = lambda *args: fout.write(struct.pack(*args))
-
-        write('<80B', *tuple([0] * 80))  # header (empty)
-        write('<I', sum(len(x) for x in all_faces))  # number of triangles
-        for faces in all_faces:
-            for f in faces:
-                p0, p1, p2 = [points_flat[f[i]] for i in order]
-                write('<3f', 0, 0, 0)  # normal vector (empty)
-                write('<3f', *p0)  # vertex 1
-                write('<3f', *p1)  # vertex 2
-                write('<3f', *p2)  # vertex 3
-                write('<H', 0)  # attribute byte count (empty)
+        fout.write(b'\0' * 80)  # header (empty)
+        fout.write(struct.pack('<I', len(triangles)))  # number of triangles
+        triangles.tofile(fout)
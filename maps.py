@@ -25,16 +25,19 @@ processed with programs like MeshLab or Blender.
 import sys
 import os
 from collections import namedtuple
+from functools import lru_cache
 
 import argparse as ap
 from configparser import ConfigParser, ParsingError
-import colorsys
+from math import radians as deg2rad
 from PIL import Image
-from numpy import cos, sqrt, pi, array, zeros, average
+from numpy import (cos, sqrt, pi, array, asarray, zeros, ones,
+                   uint8, uint32, float32, where, arange, maximum, minimum,
+                   unique, lexsort)
 
 try:
     import projections as pj
-    assert pj.__version__ == '1.3.0'
+    assert pj.__version__ == '1.4.0'
 except (ImportError, AssertionError, AttributeError) as e:
     sys.exit('projections module not ready. You may want to first run:\n'
              '  %s setup.py build_ext --inplace' % sys.executable)
@@ -111,22 +114,32 @@ def get_parser():
     return parser
 
 
-def process(args):
-    "Create a 3d file from an image and return its name"
-    if not os.path.isfile(args.image):
-        sys.exit('File %s does not exist.' % args.image)
-
-    print(green('Processing file %s (projection %s) ...' %
-                (args.image, args.projection)))
-
+def parse_args(parser, argv=None):
+    "Return the parsed arguments, using the ones in --config as defaults"
+    args = parser.parse_args(argv)
     if args.config:
         try:
             cfg = read_config(args.config)
             check_config(cfg, args)
-            update_args(args, cfg)
+            defaults = get_config_defaults(cfg)
         except (FileNotFoundError, AssertionError,
                 ValueError, ParsingError) as e:
             sys.exit('Error in file %s: %s' % (args.config, e))
+        parser.set_defaults(**defaults)
+        args = parser.parse_args(argv)  # again, so the command line wins
+        for name, value in defaults.items():
+            if getattr(args, name) == value:  # not given in the command line
+                print('- Setting %s to %s' % (name.replace('_', '-'), value))
+    return args
+
+
+def process(args):
+    "Create a 3d file from an image and return its name"
+    if not os.path.isfile(args.image):
+        sys.exit('File %s does not exist.' % args.image)
+
+    print(green('Processing file %s (projection %s) ...' %
+                (args.image, args.projection)))
 
     check_caps(args.caps)
     check_meridians(args.meridians_pos, args.meridians_widths)
@@ -148,7 +161,7 @@ def process(args):
 
     heights = get_heights(img, args.channel)
     if args.invert:
-        heights = heights.max() - heights
+        heights = heights.max() - heights  # not in place: may be read-only
 
     if args.projection in ['mollweide', 'sinusoidal'] and args.caps == 'auto':
         caps = 'none'
@@ -189,8 +202,16 @@ def process(args):
 def read_config(fname):
     "Return dict with the parameters read from configuration file fname"
     print(blue('Reading defaults from config file %s ...' % fname))
+    return parse_config(fname, os.path.getmtime(fname))
+
+
+@lru_cache(maxsize=8)
+def parse_config(fname, mtime):
+    "Return the [mapelia] section of config file fname (as it was at mtime)"
+    # Cached, so processing many images with the same config reads it once.
     cp = ConfigParser()
-    cp.read_file(open(fname))
+    with open(fname) as fin:
+        cp.read_file(fin)
     assert 'mapelia' in cp, 'Missing section [mapelia]'
     return cp['mapelia']
 
@@ -202,15 +223,14 @@ def check_config(cfg, args):
         assert key.replace('-', '_') in valid_keys, 'Unknown option "%s"' % key
 
 
-def update_args(args, cfg):
-    "Modify args with the contents of config dict cfg"
+def get_config_defaults(cfg):
+    "Return dict {argname: value} with the values in config dict cfg"
     converters = get_arguments_converters()
-    used_keys = {x[2:] for x in sys.argv if x.startswith('--')}
-    for key in cfg.keys() - used_keys:
+    defaults = {}
+    for key in cfg:
         cast = converters.get(key, lambda x: x)
-        value = cast(cfg[key])
-        print('- Setting %s to %s' % (key, value))
-        setattr(args, key.replace('-', '_'), value)
+        defaults[key.replace('-', '_')] = cast(cfg[key])
+    return defaults
 
 
 def get_arguments_converters():
@@ -244,7 +264,8 @@ def fix_ratios(img, ptype):
                       'do not look good (%dx%d).\nChanging them to %dx%d. '
                       'Consider fixing the original.' % (ptype, nx, ny, nx,
                                                          ny_expected)))
-            img = img.resize((nx, ny_expected), Image.ANTIALIAS)
+            img = img.resize((nx, ny_expected), Image.Resampling.LANCZOS,
+                             reducing_gap=2)  # fast prescale if much bigger
     return img
 
 
@@ -281,7 +302,7 @@ def check_if_exists(fname):
         try:
             answer = input('File %s already exists. Overwrite? [y/n] ' % fname)
             assert answer.lower().startswith('y')
-        except (KeyboardInterrupt, AssertionError):
+        except (KeyboardInterrupt, EOFError, AssertionError):
             sys.exit('\nCancelling.')
 
 
@@ -294,52 +315,58 @@ def get_patches(heights, projection_args, logo_args, thickness,
     caps_height = projection_args['caps_height']
     phi_cap = pj.get_phi_cap(caps, heights, projection_args['ptype'])
 
-    get_pid = lambda: patches[-1].points[-1][-1].pid + 1 if patches else 0
+    pid = 0  # id of the next point we add
+    npoints = lambda patch: sum(len(row) for row in patch.points)
 
     # Logo / North cap.
     if logo_args['north'].image:
         patch = get_logo_patch(logo_args['north'], phi_cap, caps_height,
-                               pid=get_pid(), add_faces=add_faces)
+                               pid=pid, add_faces=add_faces)
         patches.append(patch)
+        pid += npoints(patch)
         limiting_points = pj.points_at_extreme(patch.points)
     elif caps != 'none':
         patch = get_cap_patch(phi_cap, caps_height,
-                              pid=get_pid(), add_faces=add_faces)
+                              pid=pid, add_faces=add_faces)
         patches.append(patch)
+        pid += npoints(patch)
         limiting_points = patch.points[-1]
 
     # Map.
-    patch = get_map_patch(heights, projection_args, pid=get_pid(),
+    patch = get_map_patch(heights, projection_args, pid=pid,
                           add_faces=add_faces, close_figure=close_figure)
     if add_faces and patches:
         print(blue('Stitching patches...'))
         faces = pj.get_faces([limiting_points, patch.points[0]])
         patches.append(Patch([], faces))
     patches.append(patch)
+    pid += npoints(patch)
 
     # South cap.
     if logo_args['south'].image:
         patch = get_logo_patch(logo_args['south'], -phi_cap, caps_height,
-                               pid=get_pid(), add_faces=add_faces)
+                               pid=pid, add_faces=add_faces)
         if add_faces and patches:
             print(blue('Stitching patches...'))
             limiting_points = pj.points_at_extreme(patch.points)
             faces = pj.get_faces([patches[-1].points[-1], limiting_points])
             patches.append(Patch([], faces))
         patches.append(patch)
+        pid += npoints(patch)
     elif caps != 'none':
         patch = get_cap_patch(-phi_cap, caps_height,
-                              pid=get_pid(), add_faces=add_faces)
+                              pid=pid, add_faces=add_faces)
         if add_faces and patches:
             print(blue('Stitching patches...'))
             faces = pj.get_faces([patches[-1].points[-1], patch.points[0]])
             patches.append(Patch([], faces))
         patches.append(patch)
+        pid += npoints(patch)
 
     # Inner sphere (to make the ball hollow).
     if 0 < thickness < 1:
         r = 1 - thickness
-        patches.append(get_sphere_patch(r, pid=get_pid(), add_faces=add_faces))
+        patches.append(get_sphere_patch(r, pid=pid, add_faces=add_faces))
 
     return patches
 
@@ -376,9 +403,8 @@ def get_logo_patch(logo, phi_cap, caps_height, pid=0, add_faces=True):
     if not os.path.isfile(logo.image):
         sys.exit('File %s does not exist.' % logo.image)
     img = Image.open(logo.image)
-    heights_logo = get_heights(img)
-    heights_logo /= heights_logo.max()
-    heights_logo *= logo.scale
+    heights_logo = get_heights(img).astype(float32)
+    heights_logo *= logo.scale / heights_logo.max()  # in one pass
     points = pj.get_logo_points(heights_logo, phi_max=phi_cap,
                                 caps_height=caps_height, pid=pid)
     faces = pj.get_faces(points, close_figure=False) if add_faces else []
@@ -388,57 +414,86 @@ def get_logo_patch(logo, phi_cap, caps_height, pid=0, add_faces=True):
 def fill_dark(img, too_dark_value=30, darkest_fill=50):
     "Fill dark values in the image (which correspond to areas with no data)"
     print(blue('Filling dark areas with nearby color...'))
-    img_filled = img.convert('HSV')
-    last_fill = (255, 255, 255)
-    nx, ny = img_filled.size
-    for j in range(ny):
-        for i in range(nx):
-            hsv = img_filled.getpixel((i, j))
-            if hsv[2] < too_dark_value:
-                img_filled.putpixel((i, j), last_fill)
-            elif hsv[2] > darkest_fill:
-                last_fill = hsv
-    return img_filled.convert('RGBA')
+    imx = array(img.convert('HSV'))
+    pixels = imx.reshape(-1, 3)  # all the pixels, row after row
+    vals = pixels[:,2]
+    # Index of the last pixel bright enough to be used as a fill (or -1).
+    last_fill = maximum.accumulate(
+        where(vals > darkest_fill, arange(len(vals)), -1))
+    dark = vals < too_dark_value
+    fills = last_fill[dark]
+    pixels[dark] = where(fills[:,None] >= 0, pixels[fills], 255)
+    return Image.fromarray(imx, 'HSV').convert('RGBA')
 
 
 def get_heights(img, channel='val'):
     "Return an array with the heights extracted from the image"
     print(blue('Extracting heights from image (channel "%s") ...' % channel))
-    if channel in ['r', 'g', 'b', 'average']:
-        # These channels are straigthforward: higher values are higher heights.
-        imx = array(img.convert('RGBA'), dtype=float)
-        if   channel == 'r':  return imx[:,:,0]
-        elif channel == 'g':  return imx[:,:,1]
-        elif channel == 'b':  return imx[:,:,2]
-        elif channel == 'average':
-            return average(imx, axis=2)
-    elif channel in ['hue', 'sat', 'val']:
+    if channel in ['r', 'g', 'b', 'average', 'sat', 'val']:
+        # A single conversion (alpha is not a height), split in contiguous
+        # bands, is faster than slicing or reducing along the last axis.
+        bands = [asarray(band) for band in img.convert('RGB').split()]
+    if channel in ['r', 'g', 'b']:
         # These channels are straigthforward: higher values are higher heights.
-        imxHSV = array(img.convert('RGBA').convert('HSV'), dtype=float)
-        if   channel == 'hue':  return imxHSV[:,:,0]
-        elif channel == 'sat':  return imxHSV[:,:,1]
-        elif channel == 'val':  return imxHSV[:,:,2]
+        return bands[['r', 'g', 'b'].index(channel)]  # uint8, for lookups
+    elif channel == 'average':
+        heights = bands[0].astype(float32)
+        heights += bands[1]
+        heights += bands[2]
+        heights /= 3
+        return heights
+    elif channel in ['sat', 'val']:
+        # Same values as PIL's HSV (v = max, s = 255 * (max - min) / max),
+        # but without converting the whole image to get a single channel.
+        vals = maximum.reduce(bands)
+        if channel == 'val':
+            return vals
+        diffs = vals - minimum.reduce(bands)
+        return (diffs * float32(255) / maximum(vals, 1)).astype(uint8)
+    elif channel == 'hue':
+        return asarray(img.convert('HSV').getchannel('H'))  # uint8 too
     elif channel == 'color':
         # This channel is *not* straigthforward.
-        rgb2height = find_rgb_heights(img)
-        nx, ny = img.size
-        heights = zeros((ny, nx), dtype=float)
-        for j in range(ny):
-            for i in range(nx):
-                heights[j, i] = rgb2height[img.getpixel((i, j))]
-        return heights
-
-
-def find_rgb_heights(img):
-    "Return a dict to transform rgb(a) tuples to heights"
-    # It is assumed that low heights correspond to big hues, and for
-    # the same hue a lower color value corresponds to higher heights.
-    def rank(rgb):
-        r, g, b = rgb[:3]  # there may be an alpha channel -- if so, ignore it
-        hue, sat, val = colorsys.rgb_to_hsv(r, g, b)
-        return (-hue, val)
-    rgbs = sorted(set(img.getdata()), key=rank)
-    return {rgb: i for i, rgb in enumerate(rgbs)}
+        keys = get_rgba_keys(img)
+        colors, index = unique(keys, return_inverse=True)
+        return find_rgb_heights(colors)[index].reshape(keys.shape)
+
+
+def get_rgba_keys(img):
+    "Return an array with the rgba values of each pixel packed in an integer"
+    # Read each pixel's 4 bytes as one big-endian integer, so r is the most
+    # significant byte (as with r << 24 | g << 16 | b << 8 | a).
+    imx = asarray(img.convert('RGBA'))
+    return imx.view('>u4')[:,:,0].astype(uint32)
+
+
+def find_rgb_heights(colors):
+    "Return array with the heights that correspond to the given rgba colors"
+    # The colors are packed as integers. It is assumed that low heights
+    # correspond to big hues, and for the same hue a lower color value
+    # corresponds to higher heights.
+    rgb = [(colors >> shift) & 255 for shift in [24, 16, 8]]  # ignore alpha
+    hue, sat, val = rgb_to_hsv(*rgb)
+    order = lexsort((val, -hue))  # sort by -hue, and then by val
+    heights = zeros(len(colors), dtype=float32)
+    heights[order] = arange(len(colors))
+    return heights
+
+
+def rgb_to_hsv(r, g, b):
+    "Return arrays with hue, saturation and value from arrays r, g, b"
+    # Same as colorsys.rgb_to_hsv(), but working with numpy arrays.
+    r, g, b = [array(x, dtype=float) for x in [r, g, b]]
+    maxc = maximum(maximum(r, g), b)
+    minc = minimum(minimum(r, g), b)
+    rangec = maxc - minc
+    gray = (rangec == 0)  # no hue or saturation for those
+    rangec[gray] = 1  # to avoid dividing by 0 (they will be set to 0 anyway)
+    rc, gc, bc = [(maxc - x) / rangec for x in [r, g, b]]
+    hue = where(r == maxc, bc - gc, where(g == maxc, 2 + rc - bc, 4 + gc - rc))
+    hue = where(gray, 0, (hue / 6) % 1)
+    sat = where(gray, 0, rangec / where(maxc == 0, 1, maxc))
+    return hue, sat, maxc
 
 
 def blur(img, strength=2, projection='equirectangular'):
@@ -450,19 +505,24 @@ def blur(img, strength=2, projection='equirectangular'):
     nx, ny = img.size
     _, get_phi = pj.projection_functions(projection, nx, ny)
 
-    imx = array(img.convert('RGBA'), dtype=float)
+    # Number of pixels to each side that we average, for each row.
+    cphis = abs(cos(get_phi(ny // 2 - arange(ny)))) + 1e-6  # for safety
+    dilations = (ones(ny) if projection in ['mollweide', 'sinusoidal'] else
+                 maximum(1, 1 / cphis))
+    dis = minimum(ny // 4, (strength * dilations).astype(int))
+
+    imx = asarray(img.convert('RGBA'))
     imx_blurred = zeros(imx.shape, dtype='uint8')  # will be the image blurred
-    for j in range(ny):
-        y_map = ny // 2 - j
-        cphi = abs(cos(get_phi(y_map))) + 1e-6  # abs() and 1e-6 are for safety
-        dilation = (1 if projection in ['mollweide', 'sinusoidal'] else
-                    max(1, 1 / cphi))
-        di = min(ny // 4, int(strength * dilation))
-        for i in range(nx):
-            ri = [x if x < nx else x - nx for x in range(i - di, i + di + 1)]
-            imx_blurred[j,i,:] = average(imx[j,ri,:], axis=0)
+    for di in unique(dis):
+        # The sum over the 2*di+1 pixels around each one (wrapping on the x
+        # axis) is a difference of cumulative sums. We do all the rows with
+        # the same di together, a block at a time so the sums stay small.
+        ri = arange(-di, nx + di) % nx
+        rows = where(dis == di)[0]
+        nrows = 1 + 2**18 // nx  # rows per block
+        for a in range(0, len(rows), nrows):
+            js = rows[a:a+nrows]
+            sums = zeros((len(js), len(ri) + 1, 4), dtype=uint32)
+            imx[js[:,None], ri].cumsum(axis=1, out=sums[:,1:])
+            imx_blurred[js] = (sums[:,2*di+1:] - sums[:,:nx]) / (2*di + 1)
     return Image.fromarray(imx_blurred)
-
-
-def deg2rad(x):
-    return pi * x / 180
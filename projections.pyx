@@ -5,19 +5,25 @@ They are also the most computationally-intensive and thus can benefit
 from using cython.
 """
 
-__version__ = '1.3.0'
+__version__ = '1.4.0'
 
 # If you modify this file, you can recreate projections.c by running:
 #   cython3 -a projections.pyx
 # Then, you can create the python module with:
 #   python3 setup.py build_ext --inplace
 
-from collections import namedtuple
+from functools import lru_cache
+
+cimport cython
+from libc cimport math
 
 from numpy import (sin, cos, exp, arcsin, arccos, arctan, arctan2, sqrt,
-                   pi, nan, isnan, ones_like, linspace, floor)
+                   pi, nan, isnan, linspace, rint, arange, indices, zeros,
+                   ones, where, clip, errstate, dtype, empty, concatenate,
+                   split, argsort, cumsum, bincount, maximum, searchsorted,
+                   intp, intc, uint8, float32, asarray, ascontiguousarray)
 
-Point = namedtuple('Point', ['pid', 'x', 'y', 'z'])
+Point = dtype([('pid', '<i4'), ('xyz', '<f8', 3)])  # point id and coordinates
 
 red = lambda txt: '\x1b[31m%s\x1b[0m' % txt
 
@@ -27,12 +33,11 @@ def get_map_points(heights, long pid, ptype, npoints, double scale, caps,
                    double equator_width, double equator_height):
     "Return points on a sphere, modulated by the given heights"
     # The points returned look like a list of rows:
-    # [[(0, x0_0, y0_0, z0_0), (1, x0_1, y0_1, z0_1), ...],
-    #  [(n, x1_0, y1_0, z1_0), (n+1, x1_1, y1_1, z1_1), ...],
+    # [[(0, (x0_0, y0_0, z0_0)), (1, (x0_1, y0_1, z0_1)), ...],
+    #  [(n, (x1_0, y1_0, z1_0)), (n+1, (x1_1, y1_1, z1_1)), ...],
     #  ...]
+    # where each row is a numpy array of Point (with fields pid and xyz).
     # This will be useful later on to connect the points and form faces.
-    cdef double x, y, z, r, theta, phi
-
     if ptype in ['half-sphere']:
         return get_halfmap_points(heights, pid, ptype, npoints, scale)
 
@@ -40,7 +45,6 @@ def get_map_points(heights, long pid, ptype, npoints, double scale, caps,
 
     ny, nx = heights.shape
     get_theta, get_phi = projection_functions(ptype, nx, ny)
-    points = []
 
     phi_cap = get_phi_cap(caps, heights, ptype)
     if caps != 'none' and phi_cap > get_phi(ny // 2):
@@ -50,11 +54,7 @@ def get_map_points(heights, long pid, ptype, npoints, double scale, caps,
                   (180 * phi_cap / pi, 180 * get_phi(ny // 2) / pi)))
 
     # Points from the given heights.
-    hmin, hmax = heights.min(), heights.max()
-    if hmax - hmin > 1e-6:
-        radii = 1 + scale * (2 * (heights - hmin) / (hmax - hmin) - 1)
-    else:
-        radii = ones_like(heights)
+    radii = get_radii(heights, scale)
 
     n = sqrt(npoints)
     stepy = 1 if n == 0 else int(max(1, ny / (3 * n)))
@@ -62,54 +62,72 @@ def get_map_points(heights, long pid, ptype, npoints, double scale, caps,
 
     rmeridian = interpolate((0, meridians_height), (phi_cap, caps_height))
 
-    for j in range(0, ny, stepy):
-        y_map = ny // 2 - j
-        phi = get_phi(y_map)
-        if isnan(phi) or abs(phi) > phi_cap:
-            continue
-
-        row = []
-        cphi, sphi = cos(phi), sin(phi)
-        if n == 0:
-            stepx = 1
+    # First the rows we use, and how many points we take from each of them.
+    js = arange(0, ny, stepy)
+    ys_map = ny // 2 - js
+    phis = get_phi(ys_map)
+    used = ~isnan(phis) & (abs(phis) <= phi_cap)
+    js, ys_map, phis = js[used], ys_map[used], phis[used]
+
+    cphis, sphis = cos(phis), sin(phis)
+    if n == 0:
+        stepxs = ones(len(js), dtype=int)
+    else:
+        dilation = (ones(len(js)) if ptype in ['mollweide', 'sinusoidal']
+                    else 1 / cphis)
+        stepxs = (max(1, nx / n) * dilation).astype(int)
+    lengths = -(-nx // stepxs)  # number of i in arange(0, nx, stepx)
+
+    # Radius of the meridians for each row, and rows that are on the equator.
+    rmeridians = rmeridian(phis)
+    on_equator = abs(phis) < equator_width / 2
+
+    # In cylindrical projections theta only depends on i, so we can reuse
+    # its cosine and sine for all the rows.
+    cylindrical = ptype in ['mercator', 'central-cylindrical',
+                            'equirectangular']
+    if cylindrical:
+        thetas = get_theta(arange(nx) - nx // 2, 0)
+        cos_thetas, sin_thetas = cos(thetas), sin(thetas)
+
+    # Then the points, projecting many rows at once (but not so many that
+    # the arrays stop fitting in the cache), with k the row they are in.
+    points = []
+    ends = cumsum(lengths)  # where the points of each row end
+    a = 0
+    while a < len(js):
+        b = max(a + 1, searchsorted(ends, ends[a] - lengths[a] + 2**16))
+        ls = lengths[a:b]
+        k = arange(a, b).repeat(ls)
+        starts = cumsum(ls) - ls
+        i = (arange(len(k)) - starts.repeat(ls)) * stepxs[a:b].repeat(ls)
+        theta = get_theta(i - nx // 2, ys_map[a:b].repeat(ls))
+        valid = ~isnan(theta)
+        if not valid.all():
+            k, i, theta = k[valid], i[valid], theta[valid]
+
+        r = radii[js[k], i].astype(float)
+        min_meridian_widths = 2 * pi * stepxs[k] / nx
+        meridian = on_meridians(theta, meridians, min_meridian_widths)
+        r = where(meridian, rmeridians[k], r)
+        r = where(on_equator[k], equator_height, r)
+
+        if cylindrical:
+            rcphi = r * cphis[k]
+            x, y = rcphi * cos_thetas[i], rcphi * sin_thetas[i]
         else:
-            dilation = 1 if ptype in ['mollweide', 'sinusoidal'] else 1 / cphi
-            stepx = int(max(1, nx / n) * dilation)
-
-        min_meridian_width = 2 * pi * stepx / nx
-        def on_meridians(theta):
-            dist = lambda x: abs(mod_2pi(theta - x))  # angular distance
-            return any(dist(pos) <= max(width / 2, min_meridian_width)
-                       for pos, width in meridians)
-
-        for i in range(0, nx, stepx):
-            x_map = i - nx // 2
-            theta = get_theta(x_map, y_map)
-            if isnan(theta):
-                continue
-
-            if equator_width > 0 and abs(phi) < equator_width / 2:
-                r = equator_height
-            elif on_meridians(theta):
-                r = rmeridian(phi)
-            else:
-                r = radii[j, i]
-
-            x = r * cos(theta) * cphi
-            y = r * sin(theta) * cphi
-            z = r * sphi
-            row.append(Point(pid, x, y, z))
-            pid += 1
-        if row:
-            points.append(row)
+            x, y = polar_to_xy(r * cphis[k], theta)
+        block = to_points(pid, x, y, r * sphis[k])
+        pid += len(block)
+        row_ends = cumsum(bincount(k - a, minlength=b - a))
+        points += [row for row in split(block, row_ends[:-1]) if len(row) > 0]
+        a = b
 
     return points
 
 
 def get_halfmap_points(heights, long pid, ptype, npoints, double scale):
     "Return points on a half-sphere, modulated by the given heights"
-    cdef double x, y, z, r, theta, phi
-
     print('- Projecting heights on a half-sphere...')
 
     ny, nx = heights.shape
@@ -117,38 +135,77 @@ def get_halfmap_points(heights, long pid, ptype, npoints, double scale):
     points = []
 
     # Points from the given heights.
-    hmin, hmax = heights.min(), heights.max()
-    if hmax - hmin > 1e-6:
-        radii = 1 + scale * (2 * (heights - hmin) / (hmax - hmin) - 1)
-    else:
-        radii = ones_like(heights)
+    radii = get_radii(heights, scale)
 
+    xs_map = arange(nx) - nx // 2
     for j in range(0, ny):
         y_map = ny // 2 - j
 
-        row = []
-        for i in range(0, nx):
-            x_map = i - nx // 2
+        phi = get_phi(xs_map, y_map)
+        theta = get_theta(xs_map, y_map)
+        valid = ~(isnan(phi) | isnan(theta))
+        phi, theta = phi[valid], theta[valid]
 
-            phi = get_phi(x_map, y_map)
-            theta = get_theta(x_map, y_map)
-            if isnan(phi) or isnan(theta):
-                continue
+        r = radii[j, valid]
 
-            cphi = cos(phi)
-            r = radii[j, i]
-
-            x = r * cos(theta) * cphi
-            y = r * sin(theta) * cphi
-            z = r * sin(phi)
-            row.append(Point(pid, x, y, z))
-            pid += 1
-        if row:
+        x, y = polar_to_xy(r * cos(phi), theta)
+        z = r * sin(phi)
+        row = to_points(pid, x, y, z)
+        pid += len(row)
+        if len(row) > 0:
             points.append(row)
 
     return points
 
 
+def get_radii(heights, double scale, hmin=None, hmax=None):
+    "Return array of radii between 1 - scale and 1 + scale from the heights"
+    if heights.dtype == uint8:  # few values: find their radii and look up
+        return get_radii(arange(256, dtype=float32), scale,
+                         heights.min(), heights.max())[heights]
+
+    radii = heights.astype(float32)  # a copy we can work on in place
+    if hmin is None:
+        hmin, hmax = radii.min(), radii.max()
+    if hmax - hmin > 1e-6:
+        radii -= hmin
+        radii *= 2 * scale / (hmax - hmin)
+        radii += 1 - scale
+    else:
+        radii[:] = 1
+    return radii
+
+
+def to_points(long pid, x, y, z):
+    "Return row of points with consecutive pids from the coordinates arrays"
+    row = empty(len(x), dtype=Point)
+    row['pid'] = arange(pid, pid + len(x))
+    row['xyz'][:,0], row['xyz'][:,1], row['xyz'][:,2] = x, y, z
+    return row
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef polar_to_xy(double[::1] rho, double[::1] theta):
+    "Return arrays x, y from the polar coordinates rho, theta"
+    # Same as rho * cos(theta), rho * sin(theta), but in a single pass.
+    cdef Py_ssize_t n
+    x, y = empty(len(theta)), empty(len(theta))
+    cdef double[::1] xs = x, ys = y
+    for n in range(len(theta)):
+        xs[n] = rho[n] * math.cos(theta[n])
+        ys[n] = rho[n] * math.sin(theta[n])
+    return x, y
+
+
+def on_meridians(theta, meridians, min_width):
+    "Return array that is True where the angles theta lie on the meridians"
+    close = zeros(len(theta), dtype=bool)
+    for pos, width in meridians:
+        close |= abs(mod_2pi(theta - pos)) <= maximum(width / 2, min_width)
+    return close
+
+
 def interpolate(p0, p1):
     "Return a function f such that f(x0) = y0 and f(x1) = y1"
     cdef double x0, y0, x1, y1, a
@@ -160,7 +217,7 @@ def interpolate(p0, p1):
 
 def get_logo_points(heights, double phi_max, double caps_height=1, long pid=0):
     "Return list of rows with the points from the logo in fname"
-    cdef double x, y, z, r, theta, phi, dist, sign_phi, abs_phi_max
+    cdef double sign_phi, abs_phi_max
 
     print('- Projecting logo...')
     # phi_max > 0 for the north cap, < 0 for the south one.
@@ -168,28 +225,25 @@ def get_logo_points(heights, double phi_max, double caps_height=1, long pid=0):
     abs_phi_max = abs(phi_max)
 
     ny, nx = heights.shape
-    points = []
     N_2, nx_2, ny_2 = max(nx, ny) / 2, nx / 2, ny / 2
-    for j in range(ny):
-        row = []
-        for i in range(nx):
-            dist = sqrt( (i - nx_2)**2 + (j - ny_2)**2 ) / N_2
-            if dist > 1:
-                continue  # only values inside the circle
-            r = caps_height + (caps_height - 1) * heights[j, i]
-            theta = sign_phi * arctan2(ny_2 - j, i - nx_2)
-            phi = sign_phi * (pi / 2 - (pi / 2 - abs_phi_max) * dist)
-
-            x = r * cos(theta) * cos(phi)
-            y = r * sin(theta) * cos(phi)
-            z = r * sin(phi)
-            row.append(Point(pid, x, y, z))
-            pid += 1
-        if len(row) > 1:  # we want at least 2 points in a row
-            points.append(row)
-        else:
-            pid -= len(row)  # we didn't add it, so don't count it
-    return points
+    j, i = indices((ny, nx))
+    dist = sqrt( (i - nx_2)**2 + (j - ny_2)**2 ) / N_2
+    inside = dist <= 1  # only values inside the circle
+    npoints = inside.sum(axis=1)
+    inside &= (npoints > 1)[:,None]  # we want at least 2 points in a row
+    j, i, dist = j[inside], i[inside], dist[inside]
+
+    r = caps_height + (caps_height - 1) * heights[j, i]
+    theta = sign_phi * arctan2(ny_2 - j, i - nx_2)
+    phi = sign_phi * (pi / 2 - (pi / 2 - abs_phi_max) * dist)
+
+    x = r * cos(theta) * cos(phi)
+    y = r * sin(theta) * cos(phi)
+    z = r * sin(phi)
+    row_ends = cumsum(npoints[npoints > 1])
+    if len(row_ends) == 0:
+        return []
+    return split(to_points(pid, x, y, z), row_ends[:-1])
 
 
 def get_cap_points(r, phi_max, pid):
@@ -203,24 +257,20 @@ def get_cap_points(r, phi_max, pid):
 
 def get_sphere_points(double r, double phi_start, double phi_end, long pid):
     "Return lists of points on a sphere of radii r, from phi_start to phi_end"
-    cdef double x, y, z, theta, phi
+    cdef double z, phi
     cdef int nphi
 
     nphi = max(10, 21 * int(abs(phi_end - phi_start)))
     points = []
     for phi in linspace(phi_start, phi_end, nphi):
-        row = []
         z = r * sin(phi)
         if abs(z - r) < 1e-6:  # we are at an extreme
-            row.append(Point(pid, 0, 0, z))  # just put one point
-            pid += 1
+            row = to_points(pid, [0], [0], [z])  # just put one point
         else:
             rcphi = r * cos(phi)
-            for theta in linspace(-pi, pi, max(9, int(300 * cos(phi)))):
-                x = cos(theta) * rcphi
-                y = sin(theta) * rcphi
-                row.append(Point(pid, x, y, z))
-                pid += 1
+            theta = linspace(-pi, pi, max(9, int(300 * cos(phi))))
+            row = to_points(pid, cos(theta) * rcphi, sin(theta) * rcphi, z)
+        pid += len(row)
         points.append(row)
     return points
 
@@ -232,15 +282,19 @@ def get_phi_cap(caps, heights, ptype):
         get_theta, get_phi = projection_functions(ptype, nx, ny)
         if ptype in ['half-sphere']:
             return pi / 2
-        return get_phi(ny // 2)
+        return float(get_phi(ny // 2))
         # If caps == 'none' that value will only be used for the logo.
     else:  # caps is an angle then
         return pi / 2 - pi * float(caps) / 180
 
 
+@lru_cache(maxsize=8)
 def projection_functions(ptype, int nx, int ny):
     "Return functions to get theta, phi from x, y"
-    cdef double r, x, y
+    # The functions work on numbers and on numpy arrays (of x and y).
+    # It is cached because it is asked for the same image several times
+    # (when blurring, finding the caps, and projecting the map).
+    cdef double r
 
     if ptype == 'mercator':
         # Mercator projection:
@@ -274,22 +328,22 @@ def projection_functions(ptype, int nx, int ny):
         sqrt2 = sqrt(2)  # shortcut
         epsilon = 1e-8  # avoid overlapping points on the border
         r = nx / ((4 * sqrt2) - epsilon)  # reconstructing the radius from nx
+        # cos(aux) = sqrt(1 - sin(aux)**2) saves trigonometric calls, which
+        # are the most costly part when working with whole rows.
         def get_theta(x, y):
             sin_aux = y / (r * sqrt2)
-            if not -1 < sin_aux < 1:
-                return nan
-            aux = arcsin(sin_aux)
-
-            theta = pi * x / (2 * r * sqrt2 * cos(aux))
-            return theta if -pi < theta < pi else nan
+            with errstate(divide='ignore', invalid='ignore'):
+                cos_aux = sqrt(1 - clip(sin_aux, -1, 1)**2)
+                theta = pi * x / (2 * r * sqrt2 * cos_aux)
+            valid = (-1 < sin_aux) & (sin_aux < 1)
+            return where(valid & (-pi < theta) & (theta < pi), theta, nan)
         def get_phi(y):
-            sin_aux = y / (r * sqrt2)
-            if not -1 < sin_aux < 1:
-                return nan
-            aux = arcsin(sin_aux)
-
-            sin_phi = (2 * aux + sin(2 * aux)) / pi
-            return arcsin(sin_phi) if -1 < sin_phi < 1 else nan
+            sin_aux = clip(y / (r * sqrt2), -1, 1)
+            cos_aux = sqrt(1 - sin_aux**2)
+            sin_phi = (2 * arcsin(sin_aux) + 2 * sin_aux * cos_aux) / pi
+            valid = (-1 < sin_aux) & (sin_aux < 1)
+            return where(valid & (-1 < sin_phi) & (sin_phi < 1),
+                         arcsin(clip(sin_phi, -1, 1)), nan)
     elif ptype == 'equirectangular':
         # Equirectangular projection:
         #   x = r * theta
@@ -310,7 +364,7 @@ def projection_functions(ptype, int nx, int ny):
         r = nx / (2 * pi)  # reconstructing the radius from nx
         def get_theta(x, y):
             theta = x / (r * cos(y / r))
-            return theta if -pi < theta < pi else nan
+            return where((-pi < theta) & (theta < pi), theta, nan)
         def get_phi(y):
             return y / r
     elif ptype == 'half-sphere':
@@ -322,13 +376,13 @@ def projection_functions(ptype, int nx, int ny):
             return arctan2(y, x)
         def get_phi(x, y):
             r2 = x*x + y*y
-            return pi / 2 * (1 - sqrt(r2 / rmax2)) if r2 <= rmax2 else nan
+            return where(r2 <= rmax2, pi / 2 * (1 - sqrt(r2 / rmax2)), nan)
 
     return get_theta, get_phi
 
 
 def get_faces(points, close_figure=True):
-    "Return faces as triplets of point indices"
+    "Return array (n x 3) with the faces as triplets of point indices"
     # points must be a list of rows, each containing the actual points
     # that correspond to a (closed!) section of an object.
     print('- Forming faces...')
@@ -343,82 +397,121 @@ def get_faces(points, close_figure=True):
     # moved (in the previous row) until it cannot be closer to the human,
     # making triangles along the way. Then, a new triangle is made from the
     # current position to the next one and the dog (i -> i+1 -> dog).
-    faces = []
-    for j in range(1, len(points)):
-        row_previous = points[j - 1]
-        row_current = points[j]
+    # All the points together, and where each row starts (and the last ends).
+    row_starts = zeros(len(points) + 1, dtype=intp)
+    row_starts[1:] = cumsum([len(row) for row in points])
+    all_points = concatenate(points) if points else empty(0, dtype=Point)
+    pids = ascontiguousarray(all_points['pid'], dtype=intc)
+    return walk_faces(pids, norm(all_points['xyz']), row_starts, close_figure)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef walk_faces(int[::1] pids, double[:, ::1] norms,
+                Py_ssize_t[::1] row_starts, bint close_figure):
+    "Return array with the faces made by walking the dog along all the rows"
+    cdef Py_ssize_t j, i, dog, dog_walking, nfaces = 0
+    cdef Py_ssize_t start_previous, start_current, n_previous, n_current
+    cdef Py_ssize_t human, human_next
+    cdef double dist, dist_new
+    cdef int[:, ::1] faces = empty((2 * len(pids), 3), dtype=intc)
+
+    for j in range(1, len(row_starts) - 1):
+        start_previous, start_current = row_starts[j - 1], row_starts[j]
+        n_previous = start_current - start_previous
+        n_current = row_starts[j + 1] - start_current
         dog = 0
-        h = lambda: row_current[i]              # point where the human is
-        d = lambda: row_previous[dog]           # point where the dog is
-        dw = lambda: row_previous[dog_walking]  # point where the dog goes
-        for i in range(len(row_current)):
+        for i in range(n_current):
+            if nfaces + n_previous + 1 > faces.shape[0]:
+                faces = grown(faces, n_previous + 1)
+            human = start_current + i
             dog_walking = dog
-            point_norm_human = norm(h())
-            dist = dist2(point_norm_human, norm(d()))
+            dist = dist2(norms, human, start_previous + dog)
             while True:  # let the dog walk until it's as close as possible
-                dog_walking = (dog_walking + 1) % len(row_previous)
-                dist_new = dist2(point_norm_human, norm(dw()))
+                dog_walking = (dog_walking + 1) % n_previous
+                dist_new = dist2(norms, human, start_previous + dog_walking)
                 if dist_new < dist:
-                    faces.append((h().pid, dw().pid, d().pid))
+                    faces[nfaces, 0] = pids[human]
+                    faces[nfaces, 1] = pids[start_previous + dog_walking]
+                    faces[nfaces, 2] = pids[start_previous + dog]
+                    nfaces += 1
                     dog = dog_walking
                     dist = dist_new
                 else:
                     break
             # Triangle from the current position to the next one and the dog.
-            if i + 1 < len(row_current):
-                faces.append((h().pid, row_current[i + 1].pid, d().pid))
-            elif close_figure:
-                faces.append((h().pid, row_current[0].pid, d().pid))
+            if i + 1 < n_current or close_figure:
+                human_next = human + 1 if i + 1 < n_current else start_current
+                faces[nfaces, 0] = pids[human]
+                faces[nfaces, 1] = pids[human_next]
+                faces[nfaces, 2] = pids[start_previous + dog]
+                nfaces += 1
         if close_figure:
+            if nfaces + n_previous > faces.shape[0]:
+                faces = grown(faces, n_previous)
             while dog != 0:  # we have to close the figure
-                dog_walking = (dog + 1) % len(row_previous)
-                faces.append((row_current[0].pid, dw().pid, d().pid))
+                dog_walking = (dog + 1) % n_previous
+                faces[nfaces, 0] = pids[start_current]
+                faces[nfaces, 1] = pids[start_previous + dog_walking]
+                faces[nfaces, 2] = pids[start_previous + dog]
+                nfaces += 1
                 dog = dog_walking
-    return faces
+
+    return asarray(faces)[:nfaces]
 
 
-def norm(p):
-    "Return a tuple with the components of point p normalized to r=1"
-    cdef double x, y, z
-    x, y, z = p[1:4]
-    r = sqrt(x*x + y*y + z*z)
-    return x/r, y/r, z/r
+cdef int[:, ::1] grown(int[:, ::1] faces, Py_ssize_t extra):
+    "Return a copy of faces with room for (at least) extra more faces"
+    bigger = empty((2 * faces.shape[0] + extra, 3), dtype=intc)
+    bigger[:faces.shape[0]] = faces
+    return bigger
 
 
-def dist2(p0, p1):
-    "Return the geometric distance (squared) between two points"
-    cdef double x0, y0, z0, x1, y1, z1
-    x0, y0, z0 = p0
-    x1, y1, z1 = p1
-    dx, dy, dz = x1 - x0, y1 - y0, z1 - z0
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def norm(double[:, :] xyz):
+    "Return array with the coordinates xyz of the points normalized to r=1"
+    cdef Py_ssize_t i
+    cdef double r
+    normed = empty((xyz.shape[0], 3))
+    cdef double[:, ::1] p = normed
+    for i in range(xyz.shape[0]):
+        r = math.sqrt(xyz[i, 0]**2 + xyz[i, 1]**2 + xyz[i, 2]**2)
+        p[i, 0], p[i, 1], p[i, 2] = xyz[i, 0] / r, xyz[i, 1] / r, xyz[i, 2] / r
+    return normed
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline double dist2(double[:, ::1] p, Py_ssize_t i0, Py_ssize_t i1):
+    "Return the geometric distance (squared) between points p[i0] and p[i1]"
+    cdef double dx, dy, dz
+    dx, dy, dz = p[i1, 0] - p[i0, 0], p[i1, 1] - p[i0, 1], p[i1, 2] - p[i0, 2]
     return dx*dx + dy*dy + dz*dz
 
 
-def points_at_extreme(points, sample_points=[]):
-    "Return a list of points that correspond to the boundary of the given ones"
+def points_at_extreme(points, sample_points=None):
+    "Return a row of points that correspond to the boundary of the given ones"
     def r2xy(p):
-        cdef double x, y
-        _, x, y, _ = p
+        x, y = p['xyz'][:,0], p['xyz'][:,1]
         return x*x + y*y
 
-    sample_points = sample_points or points[1]
-    r2xy_limit = sum(r2xy(p) for p in sample_points) / len(sample_points)
+    if sample_points is None:
+        sample_points = points[1]
+    r2xy_limit = r2xy(sample_points).sum() / len(sample_points)
 
-    return sorted((p for row in points for p in row if r2xy(p) > r2xy_limit),
-                  key=lambda p: arctan2(p.y, p.x))
+    all_points = concatenate(points)
+    extreme = all_points[r2xy(all_points) > r2xy_limit]
+    x, y = extreme['xyz'][:,0], extreme['xyz'][:,1]
+    return extreme[argsort(arctan2(y, x), kind='stable')]
 
 
 def invert(faces):
-    "Return a list of faces with the inverse orientation"
-    inverted_faces = []
-    for p0, p1, p2 in faces:
-        inverted_faces.append((p0, p2, p1))
-    return inverted_faces
-
-
-def mod_2pi(double a):
-    "Return the equivalent to angle a in [-pi, pi)"
-    cdef int n
-    n = floor(a / (2*pi))  # number of times "a" is bigger than 2*pi
-    a0 = a - 2*pi * n  # so 0 <= a0 < 2*pi
-    return a0 if a0 < pi else a0 - 2*pi
+    "Return an array of faces with the inverse orientation"
+    return faces[:, (0, 2, 1)]
+
+
+def mod_2pi(a):
+    "Return the equivalent to angle a in [-pi, pi]"
+    n = rint(a / (2*pi))  # number of turns of 2*pi closest to "a"
+    return a - 2*pi * n